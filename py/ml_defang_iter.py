@@ -1,7 +1,21 @@
 import numpy as np
 from .ml_counters import *
 
-def ml_defang_iter(ximg, yimg, cells, stars):
+try:
+    from numba import njit
+    _has_numba = True
+except ImportError:
+    _has_numba = False
+
+    def njit(*args, **kwargs):
+        """ Stand-in for numba.njit when numba is not installed. """
+        if len(args)==1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+
+def ml_defang_iter(ximg, yimg, cells, stars, out=None):
 
     """
     NAME:
@@ -14,7 +28,7 @@ def ml_defang_iter(ximg, yimg, cells, stars):
       combination) the star field itself.
 
     CALLING SEQUENCE:
-      alphax, alphay = ml_defan_iter(ximg, yimg, cells, stars)
+      alphax, alphay = ml_defan_iter(ximg, yimg, cells, stars, [out= ])
 
     INPUTS:
       ximg  - x position in the image plane
@@ -23,12 +37,14 @@ def ml_defang_iter(ximg, yimg, cells, stars):
       stars - the stellar population (starfield class)
 
     OPTIONAL INPUTS:
+      out   - 2 element array (e.g., a view of a row of a deflection map)
+              into which alphax, alphay are written
 
     KEYWORDS:
 
     OUTPUTS:
-      alphax - x component of the deflection angle
-      alphay - y component of the deflection angle
+      alphax - x component of the deflection angle (float)
+      alphay - y component of the deflection angle (float)
 
     OPTIONAL OUTPUTS:
 
@@ -51,7 +67,6 @@ def ml_defang_iter(ximg, yimg, cells, stars):
     dt       = np.float64
     nmm      = 20
     mm       = np.arange(nmm) + 1.0
-    amp      = np.zeros(11, dtype=dt)
     cmom     = np.zeros(20, dtype=dt)
     smom     = np.zeros(20, dtype=dt)
     oormp1   = np.zeros(20, dtype=dt)
@@ -157,4 +172,227 @@ def ml_defang_iter(ximg, yimg, cells, stars):
 
         counters.clist.append(cellnum)
 
+    if out is not None:
+        out[0] = alphax
+        out[1] = alphay
+
     return alphax, alphay
+
+
+
+def ml_defang_batch(ximg, yimg, carr, sarr, cnts=None):
+
+    """
+    NAME:
+      ml_defang_batch
+
+    PURPOSE:
+      Calculate the deflection angle due to stars at many image plane 
+      positions at once.  The cell tree is walked as in ml_defang_iter 
+      but each cell is applied (with vectorized numpy operations) to all 
+      of the positions for which it is used, so there is no python loop 
+      over positions.
+
+    CALLING SEQUENCE:
+      alphax, alphay = ml_defang_batch(ximg, yimg, carr, sarr, [cnts= ])
+
+    INPUTS:
+      ximg - x positions in the image plane
+      yimg - y positions in the image plane (broadcastable against ximg)
+      carr - flat arrays of the cell parameters (see cellarrays)
+      sarr - star positions and Einstein radii (xstar, ystar, rein)
+
+    OPTIONAL INPUTS:
+      cnts - 2 element integer array to which the number of cells and 
+             stars used are added
+
+    KEYWORDS:
+
+    OUTPUTS:
+      alphax - x component of the deflection angle (broadcast shape)
+      alphay - y component of the deflection angle (broadcast shape)
+
+    OPTIONAL OUTPUTS:
+
+    EXAMPLES:
+
+    COMMENTS:
+
+    REVISION HISTORY:
+
+    ------------------------------------------------------------
+    """
+
+    # -------- unpack the cell and star arrays
+    xcell, ycell, mcell, cside, nstar, high, cmom, smom, stind = carr
+    xstar, ystar, rein = sarr
+
+
+    # -------- utilities
+    ximg, yimg = np.broadcast_arrays(ximg, yimg)
+    shape      = ximg.shape
+    ximg       = ximg.ravel().astype(np.float64)
+    yimg       = yimg.ravel().astype(np.float64)
+    mm         = np.arange(1, cmom.shape[1]+1, dtype=np.float64)[:,np.newaxis]
+    alphax     = np.zeros(ximg.size, dtype=np.float64)
+    alphay     = np.zeros(ximg.size, dtype=np.float64)
+    ncell      = 0
+    nst        = 0
+
+
+    # -------- walk the cells depth first carrying the indices of the
+    #          positions for which each cell must be considered
+    allind = np.arange(ximg.size)
+    stack  = [(cellnum, allind) for cellnum in [3,2,1,0]]
+
+    while stack:
+        cellnum, ind = stack.pop()
+
+        # -------- are there stars in this cell?
+        if nstar[cellnum]==0: continue
+
+
+        # -------- unpack the cell
+        delx  = xcell[cellnum] - ximg[ind]
+        dely  = ycell[cellnum] - yimg[ind]
+        rcell = np.sqrt(delx*delx + dely*dely)
+        near  = rcell<0.6*1.5*cside[cellnum]
+
+        # -------- break up the cell for the nearby positions
+        if near.any():
+            nind = ind[near]
+
+            if high[cellnum]!=1:
+                for k in [3,2,1,0]:
+                    stack.append((4*(cellnum+1) + k, nind))
+            else:
+                stin    = stind[cellnum]
+                stin    = stin[stin > 0]
+                delxi   = xstar[stin,np.newaxis] - ximg[nind]
+                delyi   = ystar[stin,np.newaxis] - yimg[nind]
+                mi2ori2 = (rein[stin,np.newaxis]**2)/(delxi*delxi + 
+                                                      delyi*delyi)
+
+                alphax[nind] += (delxi*mi2ori2).sum(0)
+                alphay[nind] += (delyi*mi2ori2).sum(0)
+                nst          += stin.size*nind.size
+
+            far   = ~near
+            ind   = ind[far]
+            delx  = delx[far]
+            dely  = dely[far]
+            rcell = rcell[far]
+
+            if ind.size==0: continue
+
+
+        # -------- calculate the deflection angle for the remaining 
+        #          positions up to order nmm
+        tcell   = np.arctan2(dely,delx)
+        oormp1  = rcell**(-mm-1.0)
+        cmmtc   = np.cos(mm*tcell)*oormp1
+        smmtc   = np.sin(mm*tcell)*oormp1
+        talphar = mcell[cellnum]/rcell + np.dot(cmom[cellnum],cmmtc) + \
+            np.dot(smom[cellnum],smmtc)
+        talphat = np.dot(cmom[cellnum],smmtc) - np.dot(smom[cellnum],cmmtc)
+
+        alphax[ind] += (delx*talphar - dely*talphat)/rcell
+        alphay[ind] += (dely*talphar + delx*talphat)/rcell
+        ncell       += ind.size
+
+
+    # -------- update the counts and return
+    if cnts is not None:
+        cnts[0] += ncell
+        cnts[1] += nst
+
+    return alphax.reshape(shape), alphay.reshape(shape)
+
+
+
+@njit(cache=True, fastmath=True)
+def _defang_iter_nb(ximg, yimg, carr, sarr, stack):
+
+    """
+      Compiled version of ml_defang_iter operating on flat arrays of the
+      cell and star parameters (carr and sarr, see ml_defarr) rather than
+      on a list of treecell classes and a starfield class.  The cell list
+      is walked depth first with an explicit stack (so the cells are
+      visited in the same order as in ml_defang_iter) and the number of
+      cells and stars used are returned along with the deflection angle.
+    """
+
+    # -------- unpack the cell and star arrays
+    xcell, ycell, mcell, cside, nstar, high, cmom, smom, stind = carr
+    xstar, ystar, rein = sarr
+
+
+    # -------- utilities
+    nmm    = cmom.shape[1]
+    alphax = 0.0
+    alphay = 0.0
+    ncell  = 0
+    nst    = 0
+
+    # -------- start with the four top level cells
+    stack[0], stack[1], stack[2], stack[3] = 3, 2, 1, 0
+    nstack = 4
+
+    while nstack>0:
+        # -------- grab the cell
+        nstack -= 1
+        cellnum = stack[nstack]
+
+
+        # -------- are there stars in this cell?
+        if nstar[cellnum]==0: continue
+
+
+        # -------- unpack the cell
+        delx  = xcell[cellnum] - ximg
+        dely  = ycell[cellnum] - yimg
+        rcell = np.sqrt(delx*delx + dely*dely)
+
+        # -------- break up the cell
+        if (rcell<0.6*1.5*cside[cellnum]):
+            if high[cellnum]!=1:
+                for k in range(3,-1,-1):
+                    stack[nstack] = 4*(cellnum+1) + k
+                    nstack       += 1
+            else:
+                for k in range(stind.shape[1]):
+                    ist = stind[cellnum,k]
+                    if ist <= 0: continue
+
+                    delxi    = xstar[ist] - ximg
+                    delyi    = ystar[ist] - yimg
+                    mi       = rein[ist]
+                    mi2ori2  = (mi*mi)/(delxi*delxi + delyi*delyi)
+                    alphax  += delxi*mi2ori2
+                    alphay  += delyi*mi2ori2
+                    nst     += 1
+            continue
+
+
+        # -------- calculate the deflection angle up to order nmm using
+        #          recurrences for cos(m*theta), sin(m*theta), r^-(m+1)
+        ctcell  = delx/rcell
+        stcell  = dely/rcell
+        oor     = 1.0/rcell
+        oormp1  = oor
+        cmm     = 1.0
+        smm     = 0.0
+        talphar = mcell[cellnum]*oor
+        talphat = 0.0
+
+        for i in range(nmm):
+            cmm, smm = cmm*ctcell - smm*stcell, smm*ctcell + cmm*stcell
+            oormp1  *= oor
+            talphar += (cmom[cellnum,i]*cmm + smom[cellnum,i]*smm)*oormp1
+            talphat += (cmom[cellnum,i]*smm - smom[cellnum,i]*cmm)*oormp1
+
+        alphax += (delx*talphar - dely*talphat)*oor
+        alphay += (dely*talphar + delx*talphat)*oor
+        ncell  += 1
+
+    return alphax, alphay, ncell, nst
@@ -3,12 +3,224 @@
 from __future__ import print_function
 
 import sys
+import threading
 import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
 from scipy import interpolate
 from .ml_defang_iter import *
+from .ml_defang_iter import _defang_iter_nb, _has_numba
 from .ml_counters import *
+from .ml_gencells import *
 
-def ml_defarr(xr, yr, nx, ny, cells, stars, multi=None, bins=1):
+try:
+    from numba import cuda, int64 as nb_int64
+except ImportError:
+    cuda = None
+
+# -------- size of the per-thread cell stack on the GPU (the depth first
+#          walk needs at most 4 + 3*(nlev-1) entries for nlev tree levels)
+_NSTACK = 64
+
+
+@njit(nogil=True, cache=True, fastmath=True)
+def _run_rect_nb(ximg, yimg, carr, sarr, rect, cnts):
+
+    """
+      Fill rect[i,j,:] with the deflection angle at (ximg[i],yimg[j]).
+      The GIL is released so that several y subgrids can be run at once
+      from a thread pool.  ximg and yimg must be contiguous float64
+      arrays so that the positions are read as raw doubles.  The number
+      of cells and stars used for each row are accumulated in cnts[i,0]
+      and cnts[i,1].
+    """
+
+    for i in range(ximg.size):
+        stack = np.empty(carr[0].size, dtype=np.int64)
+        xi    = ximg[i]
+
+        for j in range(yimg.size):
+            ax, ay, nc, ns = _defang_iter_nb(xi,yimg[j],carr,sarr,stack)
+
+            rect[i,j,0]  = ax
+            rect[i,j,1]  = ay
+            cnts[i,0]   += nc
+            cnts[i,1]   += ns
+
+
+
+if cuda is not None:
+    # -------- compile the same tree walk as a CUDA device function
+    _defang_iter_cuda = cuda.jit(device=True)(_defang_iter_nb.py_func)
+
+    @cuda.jit
+    def _run_rect_cuda(ximg, yimg, carr, sarr, rect, cnts):
+
+        """
+          CUDA version of _run_rect_nb with one thread per pixel.  The
+          number of cells and stars used are atomically added to
+          cnts[i,0] and cnts[i,1].
+        """
+
+        i, j = cuda.grid(2)
+
+        if (i < ximg.size) and (j < yimg.size):
+            stack = cuda.local.array(_NSTACK, nb_int64)
+            ax, ay, nc, ns = _defang_iter_cuda(ximg[i],yimg[j],carr,sarr,
+                                               stack)
+
+            rect[i,j,0] = ax
+            rect[i,j,1] = ay
+            cuda.atomic.add(cnts, (i,0), nc)
+            cuda.atomic.add(cnts, (i,1), ns)
+
+
+
+def run_rect_cuda(ximg, yimg, carr, sarr, rect, ntpb=16):
+
+    """
+      Fill rect (nx,ny,2) with the deflection angle map at the image
+      plane positions ximg (nx) and yimg (ny) on the GPU, using blocks of
+      ntpb x ntpb threads, and return the number of cells and stars used.
+      The cell and star arrays are copied to the device once.
+    """
+
+    nx, ny = ximg.size, yimg.size
+    d_carr = tuple(cuda.to_device(arr) for arr in carr)
+    d_sarr = tuple(cuda.to_device(arr) for arr in sarr)
+    d_rect = cuda.device_array((nx,ny,2), dtype=np.float64)
+    d_cnts = cuda.to_device(np.zeros([nx,2], dtype=np.int64))
+    nblock = ((nx+ntpb-1)//ntpb, (ny+ntpb-1)//ntpb)
+
+    _run_rect_cuda[nblock, (ntpb,ntpb)](cuda.to_device(ximg),
+                                        cuda.to_device(yimg),
+                                        d_carr,d_sarr,d_rect,d_cnts)
+
+    d_rect.copy_to_host(rect)
+
+    return d_cnts.copy_to_host().sum(0)
+
+
+
+def run_rect(ximg, yimg, carr, sarr, rect, progress=None, nblk=None):
+
+    """
+      Fill rect (nx,ny,2) with the deflection angle map at the image
+      plane positions ximg (nx) and yimg (ny) and return the number of
+      cells and stars used.
+      The x pixels are run in blocks of nblk rows (default nx/20) after
+      each of which the number of finished pixels is added to the shared
+      counter progress (a multiprocessing.Value) if given.  Without numba
+      each block is run through the vectorized ml_defang_batch.
+    """
+
+    nx, ny = ximg.size, yimg.size
+    nblk   = max(nx//20,1) if nblk==None else nblk
+    cnts   = np.zeros([nx,2], dtype=np.int64)
+
+    for i0 in range(0,nx,nblk):
+        i1 = min(i0+nblk,nx)
+
+        if _has_numba:
+            _run_rect_nb(ximg[i0:i1],yimg,carr,sarr,rect[i0:i1],cnts[i0:i1])
+        else:
+            rect[i0:i1,:,0], rect[i0:i1,:,1] = \
+                ml_defang_batch(ximg[i0:i1,np.newaxis],yimg,carr,sarr,
+                                cnts=cnts[i0])
+
+        if progress is not None:
+            with progress.get_lock():
+                progress.value += (i1-i0)*ny
+
+    return cnts.sum(0)
+
+
+
+def _report_progress(progress, npix, done, dt=0.1):
+
+    """ Print the number of finished pixels every dt seconds until done. """
+
+    last = -1
+
+    while not done.wait(dt):
+        if progress.value!=last:
+            last = progress.value
+            print("ML_DEFARR:     pixel {0} out of {1}".format(last, npix),
+                  end='\r')
+            sys.stdout.flush()
+
+    print("ML_DEFARR:     pixel {0} out of {1}".format(progress.value, npix))
+
+
+
+def _to_shm(arrs):
+
+    """
+      Copy a tuple of arrays into shared memory blocks and return the
+      blocks along with the (name, shape, dtype) needed to attach them.
+    """
+
+    shms, specs = [], []
+
+    for arr in arrs:
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes,1))
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        shms.append(shm)
+        specs.append((shm.name, arr.shape, arr.dtype.str))
+
+    return shms, specs
+
+
+
+def _from_shm(specs):
+
+    """ Attach to shared memory blocks and wrap them as arrays. """
+
+    shms = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    arrs = tuple(np.ndarray(shape, dtype=dtype, buffer=shm.buf) for 
+                 shm, (_, shape, dtype) in zip(shms, specs))
+
+    return shms, arrs
+
+
+
+# -------- state shared with the pool workers (set by _init_pool)
+_pool_state = {}
+
+def _init_pool(defbuf, ximg, yimg, slices, cspecs, sspecs, progress):
+
+    """ Wrap the shared deflection, cell, and star arrays. """
+
+    cshms, carr = _from_shm(cspecs)
+    sshms, sarr = _from_shm(sspecs)
+
+    _pool_state['defarr']   = np.frombuffer(defbuf, dtype=np.float64
+                                            ).reshape(ximg.size,yimg.size,2)
+    _pool_state['ximg']     = ximg
+    _pool_state['yimg']     = yimg
+    _pool_state['slices']   = slices
+    _pool_state['shms']     = cshms + sshms
+    _pool_state['carr']     = carr
+    _pool_state['sarr']     = sarr
+    _pool_state['progress'] = progress
+
+
+
+def _run_chunk(ip):
+
+    """ Fill the ip-th y subgrid of the shared deflection array. """
+
+    sl = _pool_state['slices'][ip]
+
+    return run_rect(_pool_state['ximg'],_pool_state['yimg'][sl],
+                    _pool_state['carr'],_pool_state['sarr'],
+                    _pool_state['defarr'][:,sl,:],
+                    progress=_pool_state['progress'])
+
+
+
+def ml_defarr(xr, yr, nx, ny, cells, stars, multi=None, bins=1,
+              interp_order=None):
 
     """
     NAME:
@@ -18,13 +230,16 @@ def ml_defarr(xr, yr, nx, ny, cells, stars, multi=None, bins=1):
       Calculate a map of the deflection angle in both the x and y 
       directions as a function of position in the image plane.  The 
       specified y range is broken up into N subgrids (where N=multi) 
-      and sent out to N different processors.  Parallel processing 
-      can be turned off by setting keyword "multi=False".  The grid 
+      and sent out to a pool of N threads (if numba is installed) or
+      N different processes, which write directly into a shared
+      deflection array.  Parallel processing 
+      can be turned off by setting keyword "multi=False" (or 1).  The grid 
       is initially coarse but subgridded by a factor of bins in each 
       direction.
 
     CALLING SEQUENCE:
-      defarr = ml_defarr(xr, yr, nx, ny, cells, stars, [multi =, bins= ])
+      defarr = ml_defarr(xr, yr, nx, ny, cells, stars, [multi =, bins=,
+                         interp_order= ])
 
     INPUTS:
       xr    - the x range of the image plane
@@ -35,8 +250,11 @@ def ml_defarr(xr, yr, nx, ny, cells, stars, multi=None, bins=1):
       stars - the stellar population (starfield class)
 
     OPTIONAL INPUTS:
-      multi - number of processors to use (default = 4)
+      multi - number of threads/processes to use (default = 4), or
+              'cuda' to run on the GPU
       bins  - number of subgrid bins in x and y (default = 1)
+      interp_order - spline order of the subgrid interpolation 
+                     (default = 1 (bilinear) for bins <= 4, 3 otherwise)
 
     KEYWORDS:
 
@@ -44,12 +262,15 @@ def ml_defarr(xr, yr, nx, ny, cells, stars, multi=None, bins=1):
       defarr - deflection angle map
                (defx = defarr[nx*bins,ny*bins,0]
                 defx = defarr[nx*bins,ny*bins,1])
+               in double precision, or single precision if bins > 1
 
     OPTIONAL OUTPUTS:
 
     EXAMPLES:
 
     COMMENTS:
+      The loop over image plane pixels is compiled with numba (if it is
+      installed) and run on flat arrays of the cell and star parameters.
 
     REVISION HISTORY:
       2013/05/09 - Written by Greg Dobler (KITP/UCSB)
@@ -59,109 +280,184 @@ def ml_defarr(xr, yr, nx, ny, cells, stars, multi=None, bins=1):
 
     # -------- defaults
     multi    = 4 if multi==None else multi
+    iorder   = (1 if bins<=4 else 3) if interp_order==None else interp_order
 
 
     # -------- utilities
-    if multi:
-        if ny % multi != 0:
-            print("ML_DEFARR: ERROR: Number of image plane y-pixels must be")
-            print("ML_DEFARR:  an integer number of processors!!!")
-            print("ML_DEFARR:  (i.e., nximg mod multi = 0)")
-
-            return -1
-
-        nproc = multi
-        dy    = (yr[1]-yr[0])/float(nproc)
-        yrs   = [[i*dy+yr[0],(i+1)*dy+yr[0]] for i in range(nproc)]
-
-
-    # -------- loop through the image plane
-    def run_rect(conn,xr,yr,nx,ny,cells,stars,verbose=False):
-        rect = np.zeros([nx,ny,2], dtype=np.float64)
-        ximg = np.linspace(xr[0],xr[1],nx,endpoint=False)
-        yimg = np.linspace(yr[0],yr[1],ny,endpoint=False)
-
-        for i in range(nx):
-            if verbose and ((i+1) % 5 == 0):
-                print('ML_DEFARR:     iximg = {0} out ' 
-                       'of {1}'.format(i+1, nx), end='\r')
-                sys.stdout.flush()
-
-            for j in range(ny):
-                rect[i,j,:] = ml_defang_iter(ximg[i],yimg[j],cells,stars)
-
-        if verbose:
-            print
-            print("ML_DEFARR: Total number of cells used ≈ {0}"
-                  .format(counters.cellcnt*nproc))
-            print("ML_DEFARR: Total number of stars used ≈ {0}"
-                  .format(counters.starcnt*nproc))
-
-        if multi:
-            conn.send(rect)
-            conn.close()
-        else:
-            return rect
+    gpu   = multi=='cuda'
+    nproc = multi if (multi and not gpu) else 1
+
+    if gpu and ((cuda is None) or (not cuda.is_available())):
+        print("ML_DEFARR: ERROR: multi='cuda' requires numba with a")
+        print("ML_DEFARR:  CUDA capable GPU!!!")
+
+        return -1
+
+    if ny % nproc != 0:
+        print("ML_DEFARR: ERROR: Number of image plane y-pixels must be")
+        print("ML_DEFARR:  an integer number of processors!!!")
+        print("ML_DEFARR:  (i.e., nximg mod multi = 0)")
+
+        return -1
+
+    chunk  = ny // nproc
+    slices = [slice(ip*chunk,(ip+1)*chunk) for ip in range(nproc)]
+    ximg   = np.linspace(xr[0],xr[1],nx,endpoint=False,dtype=np.float64)
+    yimg   = np.linspace(yr[0],yr[1],ny,endpoint=False,dtype=np.float64)
+
+
+    # -------- flatten the cells and stars into contiguous arrays
+    carr = cellarrays(cells)
+    sarr = (np.ascontiguousarray(stars.xstar, dtype=np.float64),
+            np.ascontiguousarray(stars.ystar, dtype=np.float64),
+            np.ascontiguousarray(stars.rein, dtype=np.float64))
 
 
     # -------- announce the method
     print("ML_DEFARR: looping through the 2D image plane with:")
-    print("ML_DEFARR:   multiprocessing      : " + ("ON" if multi  else "OFF"))
+    print("ML_DEFARR:   multiprocessing      : " + 
+          ("ON" if nproc>1 else "OFF"))
+    print("ML_DEFARR:   GPU (CUDA)           : " + ("ON" if gpu else "OFF"))
     print("ML_DEFARR:   subgrid inerpolation : " + ("ON" if bins>1 else "OFF"))
 
 
+    # -------- start reporting progress
+    progress = multiprocessing.Value('l', 0)
+    done     = threading.Event()
+    reporter = threading.Thread(target=_report_progress,
+                                args=(progress,nx*ny,done))
+    reporter.daemon = True
+    reporter.start()
+
+
     # -------- calculate the deflection angle
-    if multi:
-        print("ML_DEFARR:   running {0} processes...".format(nproc))
-
-        # -------- initialize the deflection array and processes
-        defarr  = np.zeros([nx,ny,2], dtype=np.float64)
-        parents, childs, ps = [], [], []
-
-        # -------- initialize the pipes and processes, then start
-        for ip in range(nproc):
-            ptemp, ctemp = multiprocessing.Pipe()
-            parents.append(ptemp)
-            childs.append(ctemp)
-            ps.append(multiprocessing.Process(target=run_rect,
-                                              args=(childs[ip],xr,yrs[ip],
-                                                    nx,ny//nproc,cells,stars),
-                                              kwargs={'verbose':ip==0}))
-            ps[ip].start()
-
-        # -------- collect the results, put into defarr, and rejoin
-        for ip in range(nproc):
-            yind = [ny/nproc*ip,ny/nproc*(ip+1)]
-            defarr[0:nx,yind[0]:yind[1],:] = parents[ip].recv()
-            ps[ip].join()
-    else:
-        defarr = run_rect(-314,xr,yr,nx,ny,cells,stars,verbose=True)
+    #          (always stop the progress thread, even on error)
+    try:
+        if gpu:
+            print("ML_DEFARR:   running on the GPU...")
+
+            defarr = np.empty([nx,ny,2], dtype=np.float64)
+            cnts   = run_rect_cuda(ximg,yimg,carr,sarr,defarr)
+
+            progress.value = nx*ny
+        elif nproc>1 and _has_numba:
+            print("ML_DEFARR:   running {0} threads...".format(nproc))
+
+            # -------- fill each y subgrid of defarr in place from threads
+            #          (the compiled loop releases the GIL)
+            defarr = np.empty([nx,ny,2], dtype=np.float64)
+
+            def run_chunk(ip):
+                return run_rect(ximg,yimg[slices[ip]],carr,sarr,
+                                defarr[:,slices[ip],:],progress=progress)
+
+            with ThreadPoolExecutor(max_workers=nproc) as pool:
+                cnts = np.sum(list(pool.map(run_chunk, range(nproc))), 0)
+        elif nproc>1:
+            print("ML_DEFARR:   running {0} processes...".format(nproc))
+
+            # -------- initialize the shared deflection array
+            defbuf = multiprocessing.RawArray('d', nx*ny*2)
+            defarr = np.frombuffer(defbuf, dtype=np.float64).reshape(nx,ny,2)
+
+            # -------- place the cell and star arrays in shared memory so
+            #          that the workers attach to a single copy
+            cshms, cspecs = _to_shm(carr)
+            sshms, sspecs = _to_shm(sarr)
+            del carr, sarr
+
+            # -------- fill each y subgrid in place and rejoin (the pool is
+            #          terminated on error before the blocks are unlinked)
+            try:
+                with multiprocessing.Pool(nproc, initializer=_init_pool,
+                                          initargs=(defbuf,ximg,yimg,slices,
+                                                    cspecs,sspecs,
+                                                    progress)) as pool:
+                    cnts = np.sum(pool.map(_run_chunk, range(nproc)), 0)
+                    pool.close()
+                    pool.join()
+            finally:
+                for shm in cshms + sshms:
+                    shm.close()
+                    shm.unlink()
+        else:
+            defarr = np.empty([nx,ny,2], dtype=np.float64)
+            cnts   = run_rect(ximg,yimg,carr,sarr,defarr,progress=progress)
+    finally:
+        done.set()
+        reporter.join()
+
+    counters.cellcnt += cnts[0]
+    counters.starcnt += cnts[1]
+
+    print("ML_DEFARR: Total number of cells used = {0}".format(cnts[0]))
+    print("ML_DEFARR: Total number of stars used = {0}".format(cnts[1]))
 
 
     # -------- apply subgrid interpolation if desired
     if bins>1:
         print("ML_DEFARR: applying subgrid spline interpolation " + 
-              "with bins = {0}".format(bins))
+              "with bins = {0} (order {1})".format(bins,iorder))
 
         # -------- allocate memory
-        defarr_fine = np.zeros([nx*bins,ny*bins,2],dtype=np.float64)
+        #          (single precision is ample for the interpolated map)
+        defarr_fine = np.empty([nx*bins,ny*bins,2],dtype=np.float32)
+
+        # -------- bilinear interpolation: the fractional offsets of the
+        #          fine pixels within a coarse cell are the same for every
+        #          cell, so precompute the (bins*bins,4) corner weights
+        if iorder==1:
+            frac         = np.arange(bins)/float(bins)
+            xfrac, yfrac = [i.ravel() for i in np.meshgrid(frac,frac,
+                                                           indexing='ij')]
+            wts          = np.stack([(1.0-xfrac)*(1.0-yfrac),
+                                     xfrac*(1.0-yfrac),
+                                     (1.0-xfrac)*yfrac,
+                                     xfrac*yfrac], axis=1).astype(np.float32)
+
+            # -------- lower left, lower right, upper left, and upper 
+            #          right corners of each coarse cell (the last row and
+            #          column are repeated beyond the edge)
+            defpad  = np.pad(defarr.astype(np.float32),((0,1),(0,1),(0,0)),
+                             mode='edge')
+            corners = np.array([defpad[:-1,:-1],defpad[1:,:-1],
+                                defpad[:-1,1:],defpad[1:,1:]])
+
+            # -------- blend the corners for all cells and fine pixel
+            #          offsets at once, then scatter the (bins,bins,nx,ny,2)
+            #          result into the fine array viewed as
+            #          (nx,bins,ny,bins,2)
+            print("ML_DEFARR:   interpolating alpha_x and alpha_y...")
+            blend = np.tensordot(wts,corners,axes=1).reshape(bins,bins,
+                                                             nx,ny,2)
+            defarr_fine.reshape(nx,bins,ny,bins,2)[...] = \
+                blend.transpose(2,0,3,1,4)
+
+            return defarr_fine
+
 
         # -------- define coarse and fine grids
         xcoar = np.linspace(xr[0],xr[1],nx,endpoint=False)
         ycoar = np.linspace(yr[0],yr[1],ny,endpoint=False)
-        ximg  = np.linspace(xr[0],xr[1],nx*bins,endpoint=False)
-        yimg  = np.linspace(yr[0],yr[1],ny*bins,endpoint=False)
-
-        # -------- create the two interpolations
-        xm, ym    = np.meshgrid(xcoar,ycoar,indexing='ij')
-        coarint_x = interpolate.RectBivariateSpline(xcoar,ycoar,defarr[:,:,0])
-        coarint_y = interpolate.RectBivariateSpline(xcoar,ycoar,defarr[:,:,1])
-
-        # -------- run the interpolation
-        print("ML_DEFARR:   interpolating alpha_x...")
-        defarr_fine[:,:,0] = coarint_x(ximg,yimg)
-        print("ML_DEFARR:   interpolating alpha_y...")
-        defarr_fine[:,:,1] = coarint_y(ximg,yimg)
+        xfine = np.linspace(xr[0],xr[1],nx*bins,endpoint=False)
+        yfine = np.linspace(yr[0],yr[1],ny*bins,endpoint=False)
+
+        # -------- fit and evaluate the (separable) spline for both 
+        #          components at once, one axis at a time: interpolate
+        #          along y on the coarse x rows, then fit along x once and
+        #          evaluate in blocks of nblk fine rows so that the double
+        #          precision spline output stays small (positions beyond
+        #          the last coarse pixel take the edge value)
+        print("ML_DEFARR:   interpolating alpha_x and alpha_y...")
+        nblk    = 256
+        xfine   = np.clip(xfine,xcoar[0],xcoar[-1])
+        yfine   = np.clip(yfine,ycoar[0],ycoar[-1])
+        yint    = interpolate.make_interp_spline(ycoar,defarr,k=iorder,
+                                                 axis=1)(yfine)
+        coarint = interpolate.make_interp_spline(xcoar,yint,k=iorder,axis=0)
+
+        for i0 in range(0,nx*bins,nblk):
+            defarr_fine[i0:i0+nblk] = coarint(xfine[i0:i0+nblk])
 
         # -------- return the interpolated array
         return defarr_fine
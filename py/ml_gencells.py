@@ -57,6 +57,35 @@ class treecell():
 
 
 
+def cellarrays(cells):
+
+    """
+      Pack a list of tree cells into a tuple of contiguous arrays (one
+      per cell parameter) for use in compiled loops:
+        (xcell, ycell, mcell, cside, nstar, high, cmom, smom, stind)
+      where cside is the mean side length of each cell and cmom, smom,
+      stind are stacked into (ncell, nmm) and (ncell, maxst) arrays.
+    """
+
+    ncell = len(cells)
+    f64   = np.float64
+
+    xcell = np.fromiter((c.xcell for c in cells), dtype=f64, count=ncell)
+    ycell = np.fromiter((c.ycell for c in cells), dtype=f64, count=ncell)
+    mcell = np.fromiter((c.mcell for c in cells), dtype=f64, count=ncell)
+    cside = np.fromiter((0.5*(c.xside+c.yside) for c in cells), dtype=f64,
+                        count=ncell)
+    nstar = np.fromiter((c.nstar for c in cells), dtype=np.int64,
+                        count=ncell)
+    high  = np.fromiter((c.high for c in cells), dtype=np.int64, count=ncell)
+    cmom  = np.stack([c.cmom for c in cells]).astype(f64, copy=False)
+    smom  = np.stack([c.smom for c in cells]).astype(f64, copy=False)
+    stind = np.stack([c.stind for c in cells]).astype(np.int64, copy=False)
+
+    return xcell, ycell, mcell, cside, nstar, high, cmom, smom, stind
+
+
+
 def gencells(stars):
 
     """
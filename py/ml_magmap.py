@@ -128,11 +128,6 @@ class magmap():
               .format(np.mean(nstars[np.array([i.high for i in cells])==1])))
 
 
-        # -------- initialize the deflection angle map
-        xpos   = xmin + dx*np.arange(nxpix)
-        ypos   = ymin + dy*np.arange(nypix)
-
-
         # -------- shoot the rays in the image plane (calculate the
         #          deflection angle at each point
         defarr = ml_defarr(xrimg, yrimg, nximg, nyimg, cells, stars, \
@@ -343,11 +338,10 @@ class magmap():
 
 
         # -------- interpolate onto light curve pixels
-        #          (using interp2d!!!)
         x, y   = np.arange(float(nxpix)), np.arange(float(nypix))
-        mapint = interpolate.interp2d(x,y,mmap,kind='cubic')
+        mapint = interpolate.RectBivariateSpline(x,y,mmap)
 
-        return np.array([mapint(i,j)[0] for i,j in zip(*[iy,ix])])
+        return mapint(ix,iy,grid=False)
 
 
 